@@ -1,20 +1,32 @@
 import os
+import sys
 import time
 import json
 import re
 import logging
-import base64
+import hashlib
+import signal
+import threading
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from pathlib import Path
 from io import BytesIO
-from dataclasses import dataclass
-from typing import List, Tuple, Optional
+from collections import defaultdict
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, Optional
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import fitz  # PyMuPDF
-from PIL import Image
+from PIL import Image, ImageMath
 from openai import OpenAI
+import httpx
+import pybase64
+import orjson
 
 # ================== 配置 ==================
 class Config:
@@ -22,33 +34,121 @@ class Config:
     HOMEWORK_FOLDER = r"D:\homework"  # 主监控文件夹路径
     RESULTS_FOLDER = "results"  # 处理结果保存文件夹
     PROCESSING_FOLDER = "processing"  # 处理中文件暂存文件夹
+    CACHE_FOLDER = ".cache"  # 结果缓存文件夹（位于结果文件夹内）
 
     # API设置
     MODEL = "qwen-vl-max"  # 使用的AI模型名称（支持多模态）
     TEMPERATURE = 0.3  # AI生成内容的随机性控制
     API_RETRY_TIMES = 3  # API调用失败重试次数
     API_RETRY_DELAY = 2  # API重试间隔时间（秒）
+    API_MAX_WORKERS = 8  # 并发调用API的最大线程数
+    API_MAX_CONNECTIONS = 32  # HTTP连接池大小（保持长连接复用）
+    API_PROMPT_CACHE = True  # 请求 DashScope 启用提示词前缀缓存
 
     # 图片设置
     IMAGE_MAX_SIZE = (512, 512)  # 图片最大尺寸限制
     IMAGE_QUALITY = 80  # 图片压缩质量（0-100）
+    IMAGE_QUALITY_RANGE = (60, 85)  # 动态质量搜索区间
+    IMAGE_SSIM_GOAL = 0.9  # 动态质量的 SSIM 目标
+    IMAGE_DYNAMIC_MIN_BYTES = 50 * 1024  # 小于该大小的原图不做动态质量搜索
+    IMAGE_CACHE_MAX_ITEMS = 256  # 每个进程图片去重缓存的最大条目数
+
+    # PDF解析设置
+    EXTRACT_MAX_WORKERS = os.cpu_count() or 1  # 解析进程池大小（所有文档共享同一个进程池）
+
+    # 文件监控设置
+    FILE_MAX_WORKERS = 4  # 同时处理的PDF文件数（解析进程池与API线程池由这些文件共享）
+    FILE_STABLE_TIMEOUT = 60  # 等待文件写入完成的最长时间（秒）
 
     # 支持的文件格式
     SUPPORTED_FORMATS = ['.pdf']  # 系统支持处理的文件格式
 
+# ================== 提示词与文本解析 ==================
+# 系统提示词保持逐字节不变，服务端才能命中相同前缀的缓存；不要在调用处拼接或格式化
+_STRUCTURE_SYSTEM_PROMPT = sys.intern(
+    "你是专业的试卷结构分析专家。"
+    "请以“整道题（problem）”为单位识别，保留每道题的题干（text）、子题（subquestions）和每个项对应的 page 与 related_elements（可用元素索引）。"
+    "严格返回 JSON，格式如下："
+    '{"problems":[{"id":"1","text":"题干（可为空）","related_elements":[0,1],"pages":[1],"subquestions":[{"id":"1(a)","text":"小问文本","related_elements":[2],"pages":[1]}]}]}'
+    "只返回 JSON，不要多余说明。"
+)
+_ANSWER_SYSTEM_PROMPT = sys.intern(
+    "你是专业题目解答助手。"
+    "请结合题干按小问逐个给出答案，并在每个小问后给出详细步骤与思路。"
+    "重要：最后严格返回 JSON，格式如下："
+    '{"problem_id":"1","problem_text":"题干文本（如果有）","answers":[{"sub_id":"1(a)","answer":"...","reason":"..."}]}'
+    "不要返回多余说明，若模型需要列出推导过程，请放到 reason 字段。"
+)
+
+# 题号正则（兜底识别用）：1. / 1、/ 1a) / 第1题 / 题1，整行作为题目文本
+_QUESTION_RE = re.compile(
+    r'^[^\S\n]*(?P<line>(?:(\d+[a-zA-Z]?)[^\S\n]*[.、。)]|第[^\S\n]*(\d+)[^\S\n]*题|题[^\S\n]*(\d+)).*)$',
+    re.M
+)
+
+# 模型回复中的 JSON：优先取 ```json 代码块，否则取首个 { 到最后一个 } 之间的内容
+_JSON_FENCE_RE = re.compile(r'```json\s*(.*?)\s*(?:```|\Z)', re.S)
+_JSON_OBJECT_RE = re.compile(r'\{.*\}', re.S)
+
+def _extract_json(text: str):
+    """
+    从模型回复中提取并解析 JSON，找不到时抛出 ValueError。
+    用标准库 json 解析：orjson 会把超过 64 位的整数答案转成浮点数丢失精度，且不接受 NaN。
+    """
+    match = _JSON_FENCE_RE.search(text) or _JSON_OBJECT_RE.search(text)
+    if not match:
+        raise ValueError("回复中未找到 JSON")
+    return json.loads(match.group(match.lastindex or 0))
+
+def _dump_json(data, indent=False) -> bytes:
+    """序列化为 UTF-8 JSON 字节；orjson 无法处理超过 64 位的整数，此时退回标准库 json"""
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+    try:
+        return orjson.dumps(data, option=option)
+    except TypeError:
+        return json.dumps(data, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
 # ================== 数据结构 ==================
-@dataclass
+_DATA_URL_PREFIX = "data:image/jpeg;base64,"
+
+def _to_data_url(jpeg_bytes: bytes) -> str:
+    """JPEG 字节一步生成最终的 data URL，图片元素直接保存该字符串"""
+    return _DATA_URL_PREFIX + pybase64.b64encode_as_string(jpeg_bytes)
+
+def _strip_data_url_prefix(results):
+    """
+    把结果中 sub_images 的 data URL 还原为纯 base64（保存的 JSON 格式不变）。
+    处理过程中各处都引用同一个 data URL 字符串，只在生成结果时按图片去重切片一次。
+    """
+    stripped: Dict[int, str] = {}
+    for r in results:
+        for sa in r["subanswers"]:
+            images = []
+            for url in sa["sub_images"]:
+                b64 = stripped.get(id(url))
+                if b64 is None:
+                    b64 = stripped[id(url)] = url[len(_DATA_URL_PREFIX):]
+                images.append(b64)
+            sa["sub_images"] = images
+    return results
+
+@dataclass(slots=True, frozen=True)
 class PageElement:
     """页面元素数据类，用于存储PDF中的文本和图片元素"""
     type: str  # 元素类型："text" | "image" | "page_image"
-    content: str  # 内容：文本内容 or base64编码的图片
+    content: str  # 内容：文本内容 or 图片的 data URL
     bbox: Tuple[float, float, float, float]  # 元素边界框位置坐标
     page_num: int  # 元素所在页码
-    center_y: float = 0  # 元素中心Y坐标，用于排序
-    
+    api_part: Optional[dict] = field(default=None, repr=False, compare=False)  # 预先构建的多模态消息片段
+
     def __post_init__(self):
-        # 初始化后自动计算元素的中心Y坐标
-        self.center_y = (self.bbox[1] + self.bbox[3]) / 2
+        # 创建时一次性构建 API 消息片段，之后每次组装消息都直接复用（frozen 实例需经 object.__setattr__ 赋值）
+        if self.api_part is None:
+            if self.type == "text":
+                api_part = {"type": "text", "text": self.content}
+            else:
+                api_part = {"type": "image_url", "image_url": {"url": self.content}}
+            object.__setattr__(self, "api_part", api_part)
 
 class Question:
     """题目类，用于存储识别出的题目信息"""
@@ -59,6 +159,160 @@ class Question:
         self.page_nums = page_nums or []  # 题目所在页码列表
         self.related_elements = elements or []  # 题目相关元素列表
 
+# ================== PDF页面解析（进程池工作函数） ==================
+def compress_image(img: Image.Image) -> Image.Image:
+    """压缩图片到配置的最大尺寸"""
+    if img.mode == "RGBA":
+        img = img.convert("RGB")
+    # 缩小倍数不足 2 倍时 BILINEAR 与 LANCZOS 肉眼无差别，但计算量小得多
+    ratio = max(img.size[0] / Config.IMAGE_MAX_SIZE[0], img.size[1] / Config.IMAGE_MAX_SIZE[1])
+    resample = Image.Resampling.BILINEAR if ratio < 2 else Image.Resampling.LANCZOS
+    # reducing_gap：大幅缩小时先用 box 快速缩到 3 倍以内，再做最终滤波
+    img.thumbnail(Config.IMAGE_MAX_SIZE, resample, reducing_gap=3.0)
+    return img
+
+def encode_jpeg(img: Image.Image, quality: int = Config.IMAGE_QUALITY) -> bytes:
+    """
+    将图片编码为 JPEG 字节。
+    关闭 optimize/progressive，跳过 PIL 额外的 Huffman 优化扫描；
+    BytesIO.getvalue() 在没有导出视图时直接交出内部缓冲区，不会再复制一份。
+    """
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=quality, optimize=False, progressive=False)
+    return buffered.getvalue()
+
+def _block_means(img: Image.Image, block: int) -> List[float]:
+    """F 模式图像按 block×block 不重叠窗口求均值：整数倍 BOX 缩小的每个像素正好是一个块的均值"""
+    w, h = img.size[0] // block, img.size[1] // block
+    return list(img.resize((w, h), Image.Resampling.BOX, box=(0, 0, w * block, h * block)).getdata())
+
+def _ssim(ref: Image.Image, ref_mu, ref_sq, other: Image.Image, block=8) -> float:
+    """
+    按 8×8 不重叠窗口计算两幅同尺寸 F 模式灰度图的平均 SSIM。
+    逐像素乘积与块均值都由 PIL 的 C 代码完成，Python 只遍历块统计量；ref 的统计量由调用方预先算好。
+    """
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    other_mu = _block_means(other, block)
+    other_sq = _block_means(ImageMath.eval("b * b", b=other), block)
+    cross = _block_means(ImageMath.eval("a * b", a=ref, b=other), block)
+    total = 0.0
+    for mu_a, mu_b, saa, sbb, sab in zip(ref_mu, other_mu, ref_sq, other_sq, cross):
+        var_a = saa - mu_a * mu_a
+        var_b = sbb - mu_b * mu_b
+        cov = sab - mu_a * mu_b
+        total += ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2))
+    return total / len(ref_mu) if ref_mu else 1.0
+
+def jpeg_dynamic_quality(img: Image.Image) -> int:
+    """
+    在 IMAGE_QUALITY_RANGE 内二分查找满足 SSIM 目标的最低 JPEG 质量。
+    只在 200×200 的灰度缩略图上评估，避免对整图反复编解码。
+    """
+    thumb = img.convert("L")
+    thumb.thumbnail((200, 200), Image.Resampling.BILINEAR)
+    ref = thumb.convert("F")
+    ref_mu = _block_means(ref, 8)
+    ref_sq = _block_means(ImageMath.eval("a * a", a=ref), 8)
+    lo, hi = Config.IMAGE_QUALITY_RANGE
+    while lo < hi:
+        mid = (lo + hi) // 2
+        decoded = Image.open(BytesIO(encode_jpeg(thumb, mid))).convert("F")
+        if _ssim(ref, ref_mu, ref_sq, decoded) >= Config.IMAGE_SSIM_GOAL:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+# 进程内的图片去重缓存：原图 blake2b 摘要 -> (data URL, 尺寸)，页眉/logo 等重复图片只编码一次；
+# 按内容寻址，跨文档复用也安全，超过 IMAGE_CACHE_MAX_ITEMS 时整体清空
+_IMAGE_CACHE: Dict[bytes, Tuple[str, Tuple[int, int]]] = {}
+
+def _init_extract_worker(log_queue):
+    """
+    解析子进程初始化：spawn 出的进程没有日志配置，统一经队列把日志发回主进程输出。
+    子进程忽略 SIGINT：Ctrl+C 只由主进程处理并有序关闭进程池，
+    否则子进程的 KeyboardInterrupt 会作为页面结果返回，绕过 except Exception 把 PDF 留在 processing 目录。
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+
+def _page_count(pdf_path) -> int:
+    """读取PDF页数（在解析子进程中执行，主进程的文件线程不直接调用 MuPDF）"""
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+def _process_page(pdf_path, page_num: int) -> List[PageElement]:
+    """
+    提取单页的文本与图片元素。
+    作为模块级函数供 ProcessPoolExecutor 在子进程中调用，每个进程各自打开文档。
+    """
+    logger = logging.getLogger("SmartHomeworkLogger")
+    page_elements: List[PageElement] = []
+    with fitz.open(pdf_path) as doc:
+        page = doc[page_num]
+        logger.info(f"=== 处理第 {page_num + 1} 页 ===")
+        # "blocks" 直接返回扁平的块元组 (x0, y0, x1, y1, text, block_no, block_type)，
+        # 比 "dict" 逐 span 构建字典轻得多；block_type 为 1 的是图片块，跳过
+        page_text_parts = []
+        for block in page.get_text("blocks"):
+            if len(block) >= 7 and block[6] == 0 and block[4].strip():
+                page_text_parts.append(block[4].strip())
+        if page_text_parts:
+            full_text = "\n\n".join(page_text_parts)
+            page_elements.append(PageElement("text", full_text, (0,0,page.rect.width,page.rect.height), page_num+1))
+            logger.info(f"📝 文本长度: {len(full_text)} 字符")
+        else:
+            logger.warning("⚠️ 本页未提取到文本内容")
+
+        images = page.get_images(full=True)
+        logger.info(f"🖼️ 发现 {len(images)} 个嵌入图片")
+        for img_index, img in enumerate(images):
+            try:
+                xref = img[0]
+                base_image = doc.extract_image(xref)
+                img_data = base_image["image"]
+                img_key = hashlib.blake2b(img_data, digest_size=16).digest()
+                cached = _IMAGE_CACHE.get(img_key)
+                if cached is None:
+                    width, height = base_image.get("width", 0), base_image.get("height", 0)
+                    if (base_image.get("ext") == "jpeg" and base_image.get("colorspace") in (1, 3)
+                            and 0 < width <= Config.IMAGE_MAX_SIZE[0] and 0 < height <= Config.IMAGE_MAX_SIZE[1]):
+                        # 源图已是尺寸达标的灰度/RGB JPEG，直接使用原始字节，跳过 PIL 解码与重编码
+                        cached = (_to_data_url(img_data), (width, height))
+                    else:
+                        pil_img = Image.open(BytesIO(img_data))
+                        pil_img = compress_image(pil_img)
+                        # 原图较小时直接用默认质量，不值得做动态搜索
+                        if len(img_data) < Config.IMAGE_DYNAMIC_MIN_BYTES:
+                            quality = Config.IMAGE_QUALITY
+                        else:
+                            quality = jpeg_dynamic_quality(pil_img)
+                        cached = (_to_data_url(encode_jpeg(pil_img, quality)), pil_img.size)
+                    if len(_IMAGE_CACHE) >= Config.IMAGE_CACHE_MAX_ITEMS:
+                        _IMAGE_CACHE.clear()
+                    _IMAGE_CACHE[img_key] = cached
+                data_url, (width, height) = cached
+                page_elements.append(PageElement("image", data_url, (0,0,width,height), page_num+1))
+            except Exception as e:
+                logger.warning(f"❌ 图片 {img_index+1} 处理失败: {e}")
+
+        if not images:
+            try:
+                # 直接按目标尺寸栅格化并由 PyMuPDF 输出 JPEG，省去 PNG 编解码和 PIL 缩放
+                max_w, max_h = Config.IMAGE_MAX_SIZE
+                zoom = min(2.0, max_w / page.rect.width, max_h / page.rect.height)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                img_bytes = pix.tobytes("jpeg", jpg_quality=Config.IMAGE_QUALITY)
+                page_elements.append(PageElement("page_image", _to_data_url(img_bytes), (0,0,pix.width, pix.height), page_num+1))
+                logger.info(f"📄 页面截图已添加 (页 {page_num+1})")
+            except Exception as e:
+                logger.warning(f"❌ 页面截图失败: {e}")
+    # 页内按元素中心Y坐标排序；各页再按页码顺序拼接，整体即为 (页码, 中心Y) 有序
+    page_elements.sort(key=lambda x: (x.bbox[1] + x.bbox[3]) * 0.5)
+    return page_elements
+
 # ================== 系统初始化 ==================
 def setup_directories():
     """创建必要的文件夹结构"""
@@ -93,9 +347,14 @@ def init_client(logger):
     QWEN_API = os.getenv("QWEN_API")
     if not QWEN_API:
         raise ValueError("❌ 请设置环境变量 QWEN_API")
+    # 共享的 HTTP/2 连接池：并发请求复用同一 TLS 连接，避免每次调用重新握手
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=Config.API_MAX_CONNECTIONS, max_keepalive_connections=Config.API_MAX_CONNECTIONS)
+    )
     logger.info("Qwen客户端初始化成功")
     # 创建OpenAI兼容客户端，指向阿里云DashScope服务
-    return OpenAI(api_key=QWEN_API, base_url="https://dashscope.aliyuncs.com/compatible-mode/v1")
+    return OpenAI(api_key=QWEN_API, base_url="https://dashscope.aliyuncs.com/compatible-mode/v1", http_client=http_client)
 
 # ================== 智能作业处理器 ==================
 class SmartHomeworkProcessor:
@@ -103,88 +362,104 @@ class SmartHomeworkProcessor:
     def __init__(self, logger):
         self.logger = logger
         self.client = init_client(logger)
+        # 记录 pybase64 运行时选用的编码实现（如 AVX2/SSSE3 SIMD 加速）
+        self.logger.info(f"pybase64: {pybase64.get_version()}")
+        # 常驻解析进程池：显式使用 spawn（Windows 默认方式，也避免在多线程进程中 fork），
+        # 子进程只在首次使用时启动一次，日志经队列转发给主进程已配置的 handler
+        self._mp_context = multiprocessing.get_context("spawn")
+        self._log_queue = self._mp_context.Queue()
+        self._log_listener = QueueListener(self._log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        self._log_listener.start()
+        self._extract_pool = self._new_extract_pool()
+        self._extract_pool_lock = threading.Lock()
+        # API 调用线程池同样由所有文档共享：同时处理多份PDF时并发请求总数仍不超过 API_MAX_WORKERS
+        self._api_pool = ThreadPoolExecutor(max_workers=Config.API_MAX_WORKERS)
+
+    def _new_extract_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=Config.EXTRACT_MAX_WORKERS,
+            mp_context=self._mp_context,
+            initializer=_init_extract_worker,
+            initargs=(self._log_queue,)
+        )
 
-    # ----------- 压缩图片（保持不变） -----------
-    def compress_image(self, img: Image.Image) -> Image.Image:
-        if img.mode == "RGBA":
-            img = img.convert("RGB")
-        img.thumbnail(Config.IMAGE_MAX_SIZE, Image.Resampling.LANCZOS)
-        return img
-
-    # ----------- 提取PDF元素（保持不变） -----------
+    def _renew_extract_pool(self, broken: ProcessPoolExecutor):
+        """子进程异常退出（如 MuPDF 崩溃）后进程池不可再用：关闭旧进程池并重建"""
+        with self._extract_pool_lock:
+            # 多个文件线程可能同时遇到同一个损坏的进程池，只由第一个线程替换
+            if self._extract_pool is broken:
+                self._extract_pool = self._new_extract_pool()
+                broken.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        """关闭解析进程池、API 线程池和日志转发线程"""
+        self._extract_pool.shutdown(cancel_futures=True)
+        self._api_pool.shutdown(cancel_futures=True)
+        self._log_listener.stop()
+
+    # ----------- 提取PDF元素（按页并行） -----------
     def extract_page_elements(self, pdf_path: str) -> List[PageElement]:
+        """返回按 (页码, 中心Y坐标) 排好序的元素列表，后续步骤无需再排序"""
         self.logger.info("🔍 开始提取PDF元素...")
         all_elements: List[PageElement] = []
+        # MuPDF 不是线程安全的，多个文件线程并发处理时所有 fitz 调用都放到解析子进程中执行
+        pool = self._extract_pool
         try:
-            doc = fitz.open(pdf_path)
-            for page_num in range(doc.page_count):
-                page = doc[page_num]
-                self.logger.info(f"=== 处理第 {page_num + 1} 页 ===")
-                text_dict = page.get_text("dict")
-                page_text_parts = []
-                for block in text_dict.get("blocks", []):
-                    if "lines" in block:
-                        block_text = ""
-                        for line in block["lines"]:
-                            for span in line.get("spans", []):
-                                block_text += span.get("text", "")
-                            block_text += "\n"
-                        if block_text.strip():
-                            page_text_parts.append(block_text.strip())
-                if not page_text_parts:
-                    simple_text = page.get_text("text")
-                    if simple_text.strip():
-                        page_text_parts.append(simple_text.strip())
-                if not page_text_parts:
-                    blocks = page.get_text("blocks")
-                    for block in blocks:
-                        if len(block) >= 5 and block[4].strip():
-                            page_text_parts.append(block[4].strip())
-                if page_text_parts:
-                    full_text = "\n\n".join(page_text_parts)
-                    all_elements.append(PageElement("text", full_text, (0,0,page.rect.width,page.rect.height), page_num+1))
-                    self.logger.info(f"📝 文本长度: {len(full_text)} 字符")
-                else:
-                    self.logger.warning("⚠️ 本页未提取到文本内容")
-
-                images = page.get_images(full=True)
-                self.logger.info(f"🖼️ 发现 {len(images)} 个嵌入图片")
-                for img_index, img in enumerate(images):
-                    try:
-                        xref = img[0]
-                        base_image = doc.extract_image(xref)
-                        img_data = base_image["image"]
-                        pil_img = Image.open(BytesIO(img_data))
-                        pil_img = self.compress_image(pil_img)
-                        buffered = BytesIO()
-                        pil_img.save(buffered, format="JPEG", quality=Config.IMAGE_QUALITY)
-                        img_base64 = base64.b64encode(buffered.getvalue()).decode()
-                        all_elements.append(PageElement("image", img_base64, (0,0,pil_img.size[0], pil_img.size[1]), page_num+1))
-                    except Exception as e:
-                        self.logger.warning(f"❌ 图片 {img_index+1} 处理失败: {e}")
-
-                if not images:
-                    try:
-                        mat = fitz.Matrix(2.0, 2.0)
-                        pix = page.get_pixmap(matrix=mat)
-                        img_data = pix.tobytes("png")
-                        pil_img = Image.open(BytesIO(img_data))
-                        pil_img = self.compress_image(pil_img)
-                        buffered = BytesIO()
-                        pil_img.save(buffered, format="JPEG", quality=Config.IMAGE_QUALITY)
-                        img_base64 = base64.b64encode(buffered.getvalue()).decode()
-                        all_elements.append(PageElement("page_image", img_base64, (0,0,pil_img.size[0], pil_img.size[1]), page_num+1))
-                        self.logger.info(f"📄 页面截图已添加 (页 {page_num+1})")
-                    except Exception as e:
-                        self.logger.warning(f"❌ 页面截图失败: {e}")
-
-            doc.close()
+            try:
+                page_count = pool.submit(_page_count, pdf_path).result()
+                self.logger.info(f"⚙️ 使用解析进程池并行处理 {page_count} 页")
+                # map 按页码顺序返回结果，保证元素顺序与串行处理一致
+                for page_elements in pool.map(_process_page, repeat(pdf_path), range(page_count)):
+                    all_elements.extend(page_elements)
+            except BrokenProcessPool:
+                # 重建进程池，本次按提取失败处理
+                self._renew_extract_pool(pool)
+                raise
             self.logger.info(f"✅ 提取完成，共 {len(all_elements)} 个元素")
             return all_elements
         except Exception as e:
             self.logger.error(f"PDF提取失败: {e}")
             return []
 
+    # ----------- 结果缓存（按PDF内容哈希） -----------
+    def _cache_path(self, key: str) -> Path:
+        return Path(Config.HOMEWORK_FOLDER) / Config.RESULTS_FOLDER / Config.CACHE_FOLDER / f"{key}.json"
+
+    def load_cache(self, key: str):
+        """读取缓存，不存在或损坏时返回 None"""
+        cache_file = self._cache_path(key)
+        if not cache_file.exists():
+            return None
+        try:
+            return json.loads(cache_file.read_bytes())
+        except Exception as e:
+            self.logger.warning(f"缓存读取失败 {cache_file.name}: {e}")
+            return None
+
+    def save_cache(self, key: str, data):
+        cache_file = self._cache_path(key)
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            cache_file.write_bytes(_dump_json(data))
+        except Exception as e:
+            self.logger.warning(f"缓存写入失败 {cache_file.name}: {e}")
+
+    def cache_version(self) -> str:
+        """缓存版本：模型、温度或提示词任一变化，旧缓存都不再命中"""
+        parts = [Config.MODEL, str(Config.TEMPERATURE), _STRUCTURE_SYSTEM_PROMPT, _ANSWER_SYSTEM_PROMPT]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:12]
+
+    def result_cache_key(self, doc_hash: str) -> str:
+        """完整结果缓存键：文档哈希 + 缓存版本"""
+        return f"{doc_hash}_{self.cache_version()}"
+
+    def structure_cache_key(self, doc_hash: str, elements) -> str:
+        """题目结构缓存键：文档哈希 + 缓存版本 + 按顺序的元素签名（AI 返回的元素索引依赖该顺序）"""
+        h = hashlib.sha256(f"{doc_hash}:{self.cache_version()}".encode())
+        for e in elements:
+            h.update(f"|{e.type}:{e.page_num}:{len(e.content)}".encode())
+        return f"{doc_hash}_structure_{h.hexdigest()[:16]}"
+
     # ----------- 安全API调用（保持不变） -----------
     def safe_api_call(self, messages):
         for attempt in range(Config.API_RETRY_TIMES):
@@ -192,7 +467,8 @@ class SmartHomeworkProcessor:
                 response = self.client.chat.completions.create(
                     model=Config.MODEL,
                     messages=messages,
-                    temperature=Config.TEMPERATURE
+                    temperature=Config.TEMPERATURE,
+                    extra_body={"enable_prompt_cache": True} if Config.API_PROMPT_CACHE else None
                 )
                 return response.choices[0].message.content
             except Exception as e:
@@ -201,23 +477,13 @@ class SmartHomeworkProcessor:
                     time.sleep(Config.API_RETRY_DELAY)
         return f"❌ API调用最终失败"
 
-    # ----------- 构建多模态消息（保持不变） -----------
+    # ----------- 构建多模态消息（复用预构建片段） -----------
     def build_multimodal_content(self, elements):
-        content = []
-        for element in elements:
-            if element.type == "text":
-                content.append({"type": "text", "text": element.content})
-            elif element.type in ["image", "page_image"]:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{element.content}"
-                    }
-                })
-        return content
+        # 消息片段在创建元素时已构建好，这里只做引用收集
+        return [element.api_part for element in elements]
 
     # ----------- 识别题目结构（改进：要求以“题目(problem) -> subquestions”输出） -----------
-    def identify_questions_structure(self, elements):
+    def identify_questions_structure(self, elements, doc_hash=None):
         """
         请求模型以每道大题为单位返回 JSON：
         {
@@ -236,19 +502,20 @@ class SmartHomeworkProcessor:
           ]
         }
         如果模型未按该格式返回，会退到后面的 group_questions_by_prefix() 兜底。
+        传入 doc_hash 时会复用/写入 AI 识别结果的缓存（正则兜底结果不缓存）。
+        返回 (problems, from_ai)：from_ai 为 False 表示结构来自正则兜底（API 失败或返回无法解析）。
+        elements 需为 extract_page_elements() 返回的有序列表，元素索引即基于该顺序。
         """
         self.logger.info("🧠 开始识别题目结构（按整道题分组请求模型返回 problems）...")
-        elements.sort(key=lambda x: (x.page_num, x.center_y))
+        cache_key = self.structure_cache_key(doc_hash, elements) if doc_hash else None
+        if cache_key:
+            cached = self.load_cache(cache_key)
+            if cached is not None:
+                self.logger.info(f"♻️ 命中题目结构缓存，共 {len(cached)} 道题")
+                return cached, True
         content = self.build_multimodal_content(elements)
-        system_prompt = (
-            "你是专业的试卷结构分析专家。"
-            "请以“整道题（problem）”为单位识别，保留每道题的题干（text）、子题（subquestions）和每个项对应的 page 与 related_elements（可用元素索引）。"
-            "严格返回 JSON，格式如下："
-            '{"problems":[{"id":"1","text":"题干（可为空）","related_elements":[0,1],"pages":[1],"subquestions":[{"id":"1(a)","text":"小问文本","related_elements":[2],"pages":[1]}]}]}'
-            "只返回 JSON，不要多余说明。"
-        )
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": _STRUCTURE_SYSTEM_PROMPT},
             {"role": "user", "content": content}
         ]
         result = self.safe_api_call(messages)
@@ -256,55 +523,35 @@ class SmartHomeworkProcessor:
         try:
             if not result or result.startswith("❌"):
                 raise ValueError("无效返回")
-            if "```json" in result:
-                json_str = result.split("```json")[1].split("```")[0].strip()
-            else:
-                # 尝试直接找到首个 { 到末尾的 } 的内容
-                json_candidate = result[result.find("{"): result.rfind("}")+1]
-                json_str = json_candidate.strip()
-            parsed = json.loads(json_str)
+            parsed = _extract_json(result)
             problems = parsed.get("problems") or []
             self.logger.info(f"✅ AI按题目分组识别到 {len(problems)} 道题")
             # 如果格式是旧的 questions（向后兼容），将其转换为 problems（每题作为单个 subquestion）
             if not problems and isinstance(parsed.get("questions"), list):
                 questions = parsed.get("questions")
                 problems = self.group_questions_by_prefix(questions)
-            return problems
+            if cache_key and problems:
+                self.save_cache(cache_key, problems)
+            return problems, True
         except Exception as e:
             self.logger.warning(f"AI 返回解析失败或非期望格式: {e}. 采用正则兜底并合并为 problems。")
             # 兜底：先用旧的 questions 正则方法识别小问，再按前缀合并为 problems
             questions = self.parse_questions_regex(elements)
             problems = self.group_questions_by_prefix(questions)
-            return problems
+            return problems, False
 
     # ----------- 备用正则识别（保留并返回 questions 列表） -----------
     def parse_questions_regex(self, elements):
         questions = []
-        text_content = ""
-        for element in elements:
-            if element.type == "text":
-                text_content += f"{element.content}\n"
-        lines = text_content.split('\n')
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            patterns = [
-                r'^(\d+)\s*[.、。)]',
-                r'^第\s*(\d+)\s*题',
-                r'^题\s*(\d+)',
-                r'^([0-9]+[a-zA-Z]?)\s*[.、\)]'  # 兼容 1a, 2b 等
-            ]
-            for pattern in patterns:
-                match = re.search(pattern, line)
-                if match:
-                    questions.append({
-                        "id": match.group(1),
-                        "text": line,
-                        "related_elements": [],
-                        "pages": [1]
-                    })
-                    break
+        text_content = "\n".join(e.content for e in elements if e.type == "text")
+        # 一次 finditer 扫描全文，代替逐行多次 re.search
+        for match in _QUESTION_RE.finditer(text_content):
+            questions.append({
+                "id": match.group(2) or match.group(3) or match.group(4),
+                "text": match.group("line").rstrip(),
+                "related_elements": [],
+                "pages": [1]
+            })
         self.logger.info(f"正则匹配识别到 {len(questions)} 个小问（questions）")
         return questions
 
@@ -347,6 +594,10 @@ class SmartHomeworkProcessor:
         返回 Problem 对象列表（内含 Question 对象作为 subquestions）。
         """
         self.logger.info("🎯 开始精确匹配 problems 与页面元素...")
+        # 按页码建立元素索引，智能推断时只看相关页的元素
+        by_page: Dict[int, List[PageElement]] = defaultdict(list)
+        for e in elements:
+            by_page[e.page_num].append(e)
         matched_problems = []
         for p_idx, prob in enumerate(problems_info):
             prob_id = prob.get("id", f"p{p_idx}")
@@ -366,7 +617,7 @@ class SmartHomeworkProcessor:
                         related.append(elements[idx])
                 # 如果没有索引，进行智能推断（以 subquestion 文本 与 页码为依据）
                 if not related:
-                    related = self.smart_infer_elements(sub, elements)
+                    related = self.smart_infer_elements(sub, by_page)
                 # 图片抽取
                 question_images = [e.content for e in related if e.type in ["image", "page_image"]]
                 q_obj = Question(
@@ -379,11 +630,10 @@ class SmartHomeworkProcessor:
                 subquestions_objs.append(q_obj)
                 self.logger.info(f"  小问 {q_obj.id} 匹配到 {len(question_images)} 张图")
             # 整题的 related elements 合并子题的 elements（用于整题级别的图片）
-            combined_elements = prob_related_elements[:]
-            for sq in subquestions_objs:
-                for e in sq.related_elements if hasattr(sq, "related_elements") else sq.related_elements:
-                    if e not in combined_elements:
-                        combined_elements.append(e)
+            # 按 id() 去重并保持插入顺序，避免逐个 __eq__ 比较整段图片字节的 O(N²) 扫描
+            combined = {id(e): e for e in prob_related_elements}
+            combined.update((id(e), e) for sq in subquestions_objs for e in sq.related_elements)
+            combined_elements = list(combined.values())
             # 整题对象（用 Question 来简单表示整题 / 但保持 subquestions 列表）
             problem_obj = {
                 "id": prob_id,
@@ -396,10 +646,11 @@ class SmartHomeworkProcessor:
             self.logger.info(f"大题 {prob_id} 包含 {len(subquestions_objs)} 个小问，整题相关元素 {len(combined_elements)} 个")
         return matched_problems
 
-    def smart_infer_elements(self, question_info, elements):
+    def smart_infer_elements(self, question_info, by_page):
         """
         当 AI 未提供元素索引时的启发式推断。
         question_info 可以是 dict（含 text & pages）或 Question 对象。
+        by_page 为 页码 -> 该页元素列表 的索引。
         """
         if isinstance(question_info, Question):
             question_text = question_info.text
@@ -417,8 +668,9 @@ class SmartHomeworkProcessor:
                     page_range.update([int(p)-1, int(p), int(p)+1])
                 except:
                     page_range.update([p])
-        # 筛选候选元素
-        candidate_elements = [e for e in elements if e.page_num in page_range]
+        # 筛选候选元素（按页码顺序取出，与原元素列表顺序一致；非整数页码不会匹配任何元素）
+        pages = sorted(p for p in page_range if isinstance(p, int))
+        candidate_elements = list(chain.from_iterable(by_page.get(p, []) for p in pages))
         related = []
         for element in candidate_elements:
             if element.type in ["image", "page_image"]:
@@ -437,7 +689,8 @@ class SmartHomeworkProcessor:
             现在额外在每个小回答条目中包含 sub_text（小题题目文本）和 sub_images（小题相关图片列表）。
             """
             self.logger.info("💡 开始解答 problems（每道题调用一次 AI）...")
-            all_results = []
+            # 先为每道大题构建好请求消息，再并发调用 API
+            messages_list = []
             for prob in problems:
                 prob_id = prob.get("id")
                 prob_text = prob.get("text", "") or ""  # 题干文本（如果为空则仍为 ""）
@@ -456,21 +709,22 @@ class SmartHomeworkProcessor:
                 # 添加整题相关图片（如果有）
                 for e in prob.get("related_elements", []):
                     if getattr(e, "type", None) in ["image", "page_image"]:
-                        content.append({"type":"image_url","image_url":{"url":f"data:image/jpeg;base64,{e.content}"}})
+                        content.append(e.api_part)
 
                 # 指令：一次性返回每个小问的答案（JSON），并尽可能在 JSON 中包含 problem_text 字段
-                system_prompt = (
-                    "你是专业题目解答助手。"
-                    "请结合题干按小问逐个给出答案，并在每个小问后给出详细步骤与思路。"
-                    "重要：最后严格返回 JSON，格式如下："
-                    '{"problem_id":"1","problem_text":"题干文本（如果有）","answers":[{"sub_id":"1(a)","answer":"...","reason":"..."}]}'
-                    "不要返回多余说明，若模型需要列出推导过程，请放到 reason 字段。"
-                )
-                messages = [
-                    {"role":"system","content":system_prompt},
+                messages_list.append([
+                    {"role":"system","content":_ANSWER_SYSTEM_PROMPT},
                     {"role":"user","content":content}
-                ]
-                ai_resp = self.safe_api_call(messages)
+                ])
+
+            # API 调用以网络等待为主，交给共享线程池并发发送（重试逻辑仍在 safe_api_call 内）
+            responses = list(self._api_pool.map(self.safe_api_call, messages_list))
+
+            all_results = []
+            for prob, ai_resp in zip(problems, responses):
+                prob_id = prob.get("id")
+                prob_text = prob.get("text", "") or ""
+                subqs: List[Question] = prob.get("subquestions", [])
 
                 # 解析 AI 返回的 JSON（支持 ```json 包裹）
                 parsed_answers = None
@@ -478,12 +732,7 @@ class SmartHomeworkProcessor:
                 try:
                     if not ai_resp or ai_resp.startswith("❌"):
                         raise ValueError("无效返回")
-                    if "```json" in ai_resp:
-                        json_str = ai_resp.split("```json")[1].split("```")[0].strip()
-                    else:
-                        json_candidate = ai_resp[ai_resp.find("{"): ai_resp.rfind("}")+1]
-                        json_str = json_candidate.strip()
-                    parsed = json.loads(json_str)
+                    parsed = _extract_json(ai_resp)
                     # 优先读取模型返回的 problem_text（如果有），否则使用从 PDF 提取的题干
                     model_problem_text = parsed.get("problem_text") if isinstance(parsed, dict) else None
                     parsed_answers = parsed.get("answers", []) if isinstance(parsed, dict) else []
@@ -548,30 +797,67 @@ class SmartHomeworkProcessor:
     # ----------- 完整处理流程（同名，调用上面改造后的方法） -----------
     def process_homework_complete(self, pdf_path):
         self.logger.info(f"开始智能处理: {pdf_path}")
+        # 相同内容的PDF直接返回缓存结果，跳过整条 AI 流程
+        doc_hash = hashlib.sha256(Path(pdf_path).read_bytes()).hexdigest()
+        result_key = self.result_cache_key(doc_hash)
+        cached = self.load_cache(result_key)
+        if cached is not None:
+            self.logger.info(f"♻️ 命中结果缓存: {doc_hash[:12]}")
+            return cached
         elements = self.extract_page_elements(pdf_path)
         if not elements:
             return {"error": "PDF元素提取失败", "step": 1}
-        problems_info = self.identify_questions_structure(elements)
+        problems_info, structure_from_ai = self.identify_questions_structure(elements, doc_hash)
         if not problems_info:
             return {"error": "题目识别失败", "step": 2}
         problems = self.match_questions_with_elements(problems_info, elements)
         if not problems:
             return {"error": "题目匹配失败", "step": 3}
-        results = self.answer_questions(problems)
-        return {
+        results = _strip_data_url_prefix(self.answer_questions(problems))
+        result = {
             "success": True,
             "total_elements": len(elements),
             "total_problems": len(problems),
             "results": results
         }
+        # 结构识别退回了正则兜底，或有小问的 API 调用最终失败时不写缓存，避免下次直接复用降级结果
+        api_failed = any(str(sa.get("answer") or "").startswith("❌") for r in results for sa in r["subanswers"])
+        if structure_from_ai and not api_failed:
+            self.save_cache(result_key, result)
+        return result
 
 # ================== 文件监控处理 ==================
+def _wait_for_stable(path: Path, interval=0.1, stable_for=0.3, timeout=Config.FILE_STABLE_TIMEOUT) -> bool:
+    """
+    轮询文件大小，连续 stable_for 秒不变即认为写入完成；文件消失或超时返回 False。
+    timeout 计算的是大小持续无变化的时间，慢速复制只要仍在增长就会一直等待。
+    空文件不算写入完成：部分复制工具会先创建 0 字节文件，稍后才开始写入。
+    """
+    deadline = time.monotonic() + timeout
+    last_size = -1
+    stable_since = time.monotonic()
+    while time.monotonic() < deadline:
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return False
+        now = time.monotonic()
+        if size != last_size:
+            last_size, stable_since = size, now
+            deadline = now + timeout
+        elif size > 0 and now - stable_since >= stable_for:
+            return True
+        time.sleep(interval)
+    return False
+
 class SmartFileHandler(FileSystemEventHandler):
     """文件系统事件处理器，监控文件夹变化"""
-    def __init__(self, processor, logger):
+    def __init__(self, processor, logger, executor):
         self.processor = processor
         self.logger = logger
+        self.executor = executor  # 处理文件的线程池，事件线程只负责提交
         self.processing_files = set()  # 正在处理的文件集合
+        self.lock = threading.Lock()
 
     def on_created(self, event):
         """处理文件创建事件"""
@@ -580,8 +866,7 @@ class SmartFileHandler(FileSystemEventHandler):
         file_path = Path(event.src_path)
         if file_path.suffix.lower() in Config.SUPPORTED_FORMATS:
             self.logger.info(f"🆕 检测到新文件: {file_path.name}")
-            time.sleep(2)  # 等待文件完全写入
-            self.process_file(file_path)
+            self.submit_file(file_path)
 
     def on_moved(self, event):
         """处理文件移动事件（拖拽操作）"""
@@ -590,15 +875,23 @@ class SmartFileHandler(FileSystemEventHandler):
         dest_path = Path(event.dest_path)
         if dest_path.suffix.lower() in Config.SUPPORTED_FORMATS:
             self.logger.info(f"📁 检测到拖入文件: {dest_path.name}")
-            time.sleep(1)
-            self.process_file(dest_path)
+            self.submit_file(dest_path)
+
+    def submit_file(self, file_path):
+        """登记并提交文件到线程池；同一文件的 created/moved 重复事件只处理一次"""
+        with self.lock:
+            if str(file_path) in self.processing_files:
+                return
+            self.processing_files.add(str(file_path))
+        self.executor.submit(self.process_file, file_path)
 
     def process_file(self, file_path):
         """处理检测到的文件"""
-        if str(file_path) in self.processing_files:
-            return
         try:
-            self.processing_files.add(str(file_path))
+            # 等待文件写入完成（大小不再变化）
+            if not _wait_for_stable(file_path):
+                self.logger.warning(f"⚠️ 文件不存在或未写入完成，跳过: {file_path.name}")
+                return
             # 移动文件到处理文件夹
             processing_path = Path(Config.HOMEWORK_FOLDER) / Config.PROCESSING_FOLDER / file_path.name
             if file_path != processing_path:
@@ -619,14 +912,17 @@ class SmartFileHandler(FileSystemEventHandler):
             
             processing_path.rename(results_path)
             self.logger.info(f"📄 文件已移动到结果文件夹: {results_path.name}")
+        except Exception as e:
+            self.logger.error(f"❌ 文件处理失败 {file_path.name}: {e}")
         finally:
-            self.processing_files.discard(str(file_path))
+            with self.lock:
+                self.processing_files.discard(str(file_path))
 
     def save_smart_result(self, pdf_path, result):
         """保存处理结果到JSON文件"""
         result_file = Path(Config.HOMEWORK_FOLDER) / Config.RESULTS_FOLDER / f"{pdf_path.stem}_result.json"
-        with open(result_file, "w", encoding="utf-8") as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
+        # 直接输出 UTF-8 字节（不做 ASCII 转义），以二进制写入
+        result_file.write_bytes(_dump_json(result, indent=True))
         self.logger.info(f"✅ 智能处理结果已保存: {result_file}")
 
 # ================== 主程序入口 ==================
@@ -635,17 +931,22 @@ def main():
     setup_directories()  # 初始化文件夹
     logger = setup_logging()  # 初始化日志
     processor = SmartHomeworkProcessor(logger)  # 创建处理器
-    event_handler = SmartFileHandler(processor, logger)  # 创建文件处理器
+    executor = ThreadPoolExecutor(max_workers=Config.FILE_MAX_WORKERS)  # 多个PDF并行处理
+    event_handler = SmartFileHandler(processor, logger, executor)  # 创建文件处理器
     observer = Observer()  # 创建文件监控器
     observer.schedule(event_handler, Config.HOMEWORK_FOLDER, recursive=False)
     observer.start()  # 启动监控
     logger.info("🚀 智能作业系统已启动，开始监控文件夹...")
     try:
-        while True:
-            time.sleep(1)  # 主循环
+        # 带超时的 join：Windows 上无超时的 join 无法被 Ctrl+C 打断
+        while observer.is_alive():
+            observer.join(timeout=1)
     except KeyboardInterrupt:
         observer.stop()  # 处理Ctrl+C中断
     observer.join()
+    # 监控停止后不再有新提交：取消排队中的文件，只等待正在处理的文件结束
+    executor.shutdown(wait=True, cancel_futures=True)
+    processor.close()
 
 if __name__ == "__main__":
     main()  # 程序入口
\ No newline at end of file